@@ -1,25 +1,13 @@
-import json
-import os
+import asyncio
+import io
+import itertools
 import re
-import urllib.request
-from types import coroutine
+import threading
+import time
 
+import requests
 from jupyterhub.spawner import LocalProcessSpawner, Spawner
-from rich import inspect
-from tornado import concurrent, gen
-from tornado.ioloop import IOLoop
-from traitlets import (
-    Any,
-    Dict,
-    Float,
-    Instance,
-    Integer,
-    List,
-    Tuple,
-    Type,
-    Unicode,
-    directional_link,
-)
+from traitlets import Any, Dict, Float, List, Tuple, Type, Unicode
 
 # Only needed for DockerProfilesSpawner
 try:
@@ -138,18 +126,18 @@ class CustomDockerProfilesSpawner(WrapSpawner):
 
     # Example images for dummy groups
     group_images = {
-        "group_a": [
+        "group_a": (
             (
                 "base image group_a",
                 "jupyterhub/singleuser",
-            )
-        ],
-        "group_b": [
+            ),
+        ),
+        "group_b": (
             (
                 "base image group_b",
                 "jupyterhub/singleuser",
             ),
-        ],
+        ),
     }
 
     default_profile_image = List(
@@ -167,33 +155,79 @@ class CustomDockerProfilesSpawner(WrapSpawner):
         default_value={}, config=True, help="Args to pass to DockerSpawner."
     )
 
-    jupyterhub_docker_tag_re = re.compile("^.*jupyterhub$")
+    jupyterhub_docker_tag_re = re.compile(r"jupyterhub\Z")
+
+    cache_ttl = Float(
+        30.0,
+        config=True,
+        help="""Seconds to reuse the list of jupyterhub docker image tags, the
+            nvidia-docker arguments and the rendered options form before
+            building them again.""",
+    )
+
+    nvidia_timeout = Float(
+        1.0,
+        config=True,
+        help="Timeout in seconds for the request to the nvidia-docker plugin.",
+    )
+
+    # Long-lived docker client, created on first use
+    _docker_client = None
+
+    # (timestamp, tags) of the last docker image listing
+    _docker_tags_cache = None
+
+    # (expiry, profiles) of the profiles built from default_profiles and the
+    # docker images
+    _profiles_cache = None
+
+    # Cached profiles by unique key, the first profile wins on duplicates
+    _profile_by_key = None
+
+    # (expiry, args) of the last nvidia-docker plugin query
+    _nvidia_cache = None
+
+    # Keep-alive HTTP session for the nvidia-docker plugin, created on first use
+    _http_session = None
+
+    # (key, expiry, html) of the last rendered options form, keyed on the
+    # groups and the profiles' display names and keys
+    _form_cache = None
+
+    # Deduplicated images offered to a list of groups: tuple(groups) -> images
+    _images_for_groups_cache = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # The docker client and the HTTP session are used both from the event
+        # loop and from executor threads (see _collect_profiles)
+        self._docker_lock = threading.Lock()
+        self._http_lock = threading.Lock()
 
     def options_from_form(self, formdata):
         # Default to first profile if somehow none is provided
         return dict(
             profile=formdata.get("profile", [self.profiles[0][1]])[0],
-            dockerImage=formdata.get("dockerImage", [self.images[0][1]])[0],
+            dockerImage=formdata.get("dockerImage", [self.images()[0][1]])[0],
         )
 
     def select_profile(self, profile, image):
         # Select matching profile, or do nothing (leaving previous or default config in place)
-        for p in self.profiles:
-            if p[1] == profile:
-                self.child_class = p[2]
-                self.child_config = p[3]
-                # Insert the specific image to child_config
-                # NOTE: child_config will contains all the additional parameters
-                # of the selected spawner
-                self.child_config["image"] = image
+        p = self._profiles_by_key().get(profile)
+        if p is not None:
+            self.child_class = p[2]
+            # Insert the specific image to child_config, on a copy since the
+            # profiles are cached between calls
+            # NOTE: child_config will contains all the additional parameters
+            # of the selected spawner
+            self.child_config = {**p[3], "image": image}
 
-                inspect(self.child_config)
-
-                break
+            self.log.debug("Selected child config: %r", self.child_config)
 
     def construct_child(self):
-        self.child_profile = self.user_options.get("profile", "")
-        self.profile_image = self.user_options.get("dockerImage", "")
+        user_options = self.user_options
+        self.child_profile = user_options.get("profile", "")
+        self.profile_image = user_options.get("dockerImage", "")
         self.select_profile(self.child_profile, self.profile_image)
         super().construct_child()  # this is where the wrapper take effect
 
@@ -216,100 +250,207 @@ class CustomDockerProfilesSpawner(WrapSpawner):
         super().clear_state()
         self.child_profile = ""
         self.profile_image = ""
+        self._nvidia_cache = None
+        self._profiles_cache = None
+        self._form_cache = None
 
     def _nvidia_args(self):
+        now = time.monotonic()
+        if self._nvidia_cache is not None:
+            expiry, nvidia_args = self._nvidia_cache
+            if now < expiry:
+                return nvidia_args
+
+        nvidia_args = self._fetch_nvidia_args()
+        self._nvidia_cache = (now + self.cache_ttl, nvidia_args)
+        return nvidia_args
+
+    def _fetch_nvidia_args(self):
         try:
-            resp = urllib.request.urlopen("http://localhost:3476/v1.0/docker/cli/json")
-            body = resp.read().decode("utf-8")
-            args = json.loads(body)
+            with self._http_lock:
+                if self._http_session is None:
+                    self._http_session = requests.Session()
+                resp = self._http_session.get(
+                    "http://localhost:3476/v1.0/docker/cli/json",
+                    timeout=self.nvidia_timeout,
+                )
+            resp.raise_for_status()
+            args = resp.json()
             return dict(
-                read_only_volumes={
-                    vol.split(":")[0]: vol.split(":")[1] for vol in args["Volumes"]
-                },
+                read_only_volumes=dict(vol.split(":")[:2] for vol in args["Volumes"]),
                 extra_create_kwargs={"volume_driver": args["VolumeDriver"]},
                 extra_host_config={"devices": args["Devices"]},
             )
-        except urllib.error.URLError:
+        except requests.RequestException:
             return {}
 
-    def _docker_profile(self, nvidia_args, image):
-        spawner_args = dict(container_image=image, network_name=self.user.name)
-        spawner_args.update(self.docker_spawner_args)
-        spawner_args.update(nvidia_args)
-        nvidia_enabled = "w/GPU" if len(nvidia_args) > 0 else "no GPU"
+    def _docker_profile(self, nvidia_enabled, base_args, image):
         return (
             "Docker: (%s): %s" % (nvidia_enabled, image),
             "docker-%s" % (image),
             "dockerspawner.SystemUserSpawner",
-            spawner_args,
+            {"container_image": image, **base_args},
         )
 
-    def _jupyterhub_docker_tags(self):
-        try:
-            include_jh_tags = lambda tag: self.jupyterhub_docker_tag_re.match(tag)
-            return filter(
-                include_jh_tags,
-                [
-                    tag
-                    for image in docker.from_env().images.list()
-                    for tag in image.tags
-                ],
-            )
-        except NameError:
-            raise Exception(
-                "The docker package is not installed and is a dependency for DockerProfilesSpawner"
-            )
+    def _docker(self):
+        if self._docker_client is None:
+            try:
+                self._docker_client = docker.from_env()
+            except NameError:
+                raise Exception(
+                    "The docker package is not installed and is a dependency for DockerProfilesSpawner"
+                )
+        return self._docker_client
 
-    def _docker_profiles(self):
+    def _jupyterhub_docker_tags(self):
+        now = time.monotonic()
+        if self._docker_tags_cache is not None:
+            timestamp, tags = self._docker_tags_cache
+            if now - timestamp < self.cache_ttl:
+                return tags
+
+        tags = self._list_docker_tags()
+        self._docker_tags_cache = (now, tags)
+        return tags
+
+    def _list_docker_tags(self):
+        # The low-level API returns plain dicts, no need to build Image models
+        with self._docker_lock:
+            images = self._docker().api.images()
+        match = self.jupyterhub_docker_tag_re.search
         return [
-            self._docker_profile(self._nvidia_args(), tag)
-            for tag in self._jupyterhub_docker_tags()
+            tag for image in images for tag in image.get("RepoTags") or () if match(tag)
         ]
 
+    def _docker_profiles(self, tags, nvidia_args):
+        # Spawner args shared by all the images, merged once
+        nvidia_enabled = "w/GPU" if len(nvidia_args) > 0 else "no GPU"
+        base_args = {
+            "network_name": self.user.name,
+            **self.docker_spawner_args,
+            **nvidia_args,
+        }
+        return [self._docker_profile(nvidia_enabled, base_args, tag) for tag in tags]
+
+    def _compute_profiles(self, tags, nvidia_args):
+        return self.default_profiles + self._docker_profiles(tags, nvidia_args)
+
+    def _cached_profiles(self):
+        cache = self._profiles_cache
+        if cache is not None:
+            expiry, profiles = cache
+            if time.monotonic() < expiry:
+                return profiles
+        return None
+
+    def _store_profiles(self, profiles):
+        self._profile_by_key = {p[1]: p for p in reversed(profiles)}
+        self._profiles_cache = (time.monotonic() + self.cache_ttl, profiles)
+        return profiles
+
+    def _refresh_profiles(self):
+        profiles = self._cached_profiles()
+        if profiles is None:
+            profiles = self._store_profiles(
+                self._compute_profiles(
+                    self._jupyterhub_docker_tags(), self._nvidia_args()
+                )
+            )
+        return profiles
+
+    def _profiles_by_key(self):
+        self._refresh_profiles()
+        return self._profile_by_key
+
     @property
     def profiles(self):
-        return self.default_profiles + self._docker_profiles()
+        return self._refresh_profiles()
 
     def images(self, group: str = "") -> Any:
         if group:
-            return self.group_images.get(group, [])
+            return self.group_images.get(group, ())
         return self.default_profile_image
 
+    def _images_for_groups(self):
+        if self._images_for_groups_cache is None:
+            self._images_for_groups_cache = {}
+        key = tuple(self.groups)
+        images = self._images_for_groups_cache.get(key)
+        if images is None:
+            # Groups may share images, offer each one only once
+            seen = set()
+            images = []
+            for p in itertools.chain.from_iterable(self.images(g) for g in self.groups):
+                if p[1] not in seen:
+                    seen.add(p[1])
+                    images.append(p)
+            images = self._images_for_groups_cache[key] = tuple(images)
+        return images
+
+    async def _collect_profiles(self):
+        profiles = self._cached_profiles()
+        if profiles is not None:
+            return profiles
+        # Query the docker daemon and the nvidia-docker plugin concurrently,
+        # off the event loop. The executor threads only fetch; the caches are
+        # updated here, back on the loop.
+        loop = asyncio.get_running_loop()
+        tags, nvidia_args = await asyncio.gather(
+            loop.run_in_executor(None, self._list_docker_tags),
+            loop.run_in_executor(None, self._fetch_nvidia_args),
+        )
+        now = time.monotonic()
+        self._docker_tags_cache = (now, tags)
+        self._nvidia_cache = (now + self.cache_ttl, nvidia_args)
+        return self._store_profiles(self._compute_profiles(tags, nvidia_args))
+
+    async def get_options_form(self):
+        # NOTE: coroutines like self.user.get_auth_state can be awaited here
+        return self._options_form(await self._collect_profiles())
+
     @property
     def options_form(self):
-        # --------------------- If using nested coroutines ---------------------
-        # Used to call get_auth_state coroutine inside the tornado IOLoop (asyncio wrapper)
-        # import nest_asyncio
-        # nest_asyncio.apply()
+        return self._options_form(self.profiles)
+
+    def _options_form(self, profiles):
+        self.log.debug(
+            "Options form for groups %r (admin access: %r)",
+            self.groups,
+            self.admin_access,
+        )
 
-        # Get the IOLoop and run the get_auth_state coroutine
-        # io_loop = IOLoop.current()
-        # auth_state = io_loop.run_sync(self.user.get_auth_state)
-        # inspect(auth_state)
-        # self.groups = auth_state.get("groups", [])
+        key = (tuple(self.groups), tuple((p[0], p[1]) for p in profiles))
+        now = time.monotonic()
+        if self._form_cache is not None:
+            cached_key, expiry, form = self._form_cache
+            if cached_key == key and now < expiry:
+                return form
 
-        inspect(self.groups)
-        inspect(self.admin_access)
+        form = self._render_options_form(profiles)
+        self._form_cache = (key, now + self.cache_ttl, form)
+        return form
 
+    def _render_options_form(self, profiles):
         # Profiles
-        temp_keys = [
-            dict(display=p[0], key=p[1], type=p[2], first="") for p in self.profiles
-        ]
-        temp_keys[0]["first"] = self.first_template
+        render_profile = self.input_template.format
+        buf = io.StringIO()
+        write = buf.write
+        first = self.first_template
+        for p in profiles:
+            write(render_profile(display=p[0], key=p[1], type=p[2], first=first))
+            first = ""
+        text = buf.getvalue()
+
         # Images
-        temp_images = []
-        for group in self.groups:
-            temp_images += [
-                dict(display=p[0], key=p[1], first="") for p in self.images(group)
-            ]
-
-        if temp_images:
-            temp_images[0]["first"] = self.first_template
-
-        text = "".join([self.input_template.format(**tk) for tk in temp_keys])
-        textImages = "".join(
-            [self.input_image_template.format(**tk) for tk in temp_images]
-        )
+        render_image = self.input_image_template.format
+        buf = io.StringIO()
+        write = buf.write
+        first = self.first_template
+        for p in self._images_for_groups():
+            write(render_image(display=p[0], key=p[1], first=first))
+            first = ""
+        textImages = buf.getvalue()
+
         return self.form_template.format(
             input_template=text, input_image_template=textImages
         )